@@ -0,0 +1,46 @@
+class Bitfield:
+    """
+    Minimal bitfield backed by a bytearray.
+    Bits are stored most significant first, the layout of the Bitfield message
+    """
+    def __init__(self, data=b''):
+        self._bytes = bytearray(data)
+        # Number of set bits, kept up to date by set()
+        self._count = int.from_bytes(self._bytes, 'big').bit_count()
+
+    @classmethod
+    def zeros(cls, length: int):
+        """Create an empty bitfield able to hold length bits"""
+        return cls(bytes((length + 7) // 8))
+
+    def set(self, index: int, value=1):
+        mask = 0x80 >> (index & 7)
+        byte = self._bytes[index >> 3]
+        if value and not byte & mask:
+            self._bytes[index >> 3] = byte | mask
+            self._count += 1
+        elif not value and byte & mask:
+            self._bytes[index >> 3] = byte & ~mask
+            self._count -= 1
+
+    def __getitem__(self, index: int) -> int:
+        return (self._bytes[index >> 3] >> (7 - (index & 7))) & 1
+
+    def __setitem__(self, index: int, value):
+        self.set(index, value)
+
+    def __len__(self):
+        return len(self._bytes) * 8
+
+    @property
+    def bytes(self) -> bytes:
+        return bytes(self._bytes)
+
+    def tobytes(self) -> bytes:
+        return self.bytes
+
+    def count_ones(self) -> int:
+        return self._count
+
+    def __str__(self):
+        return "0b" + "".join(f"{byte:08b}" for byte in self._bytes)
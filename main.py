@@ -6,205 +6,383 @@ import socket
 import message
 from requests import get
 import os
+import errno
+import struct
 import sys
 import time
+import logging
+import functools
+import json
+import ipaddress
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-# Get our public IP for filtering out self-connection
-ip = get('https://api.ipify.org').content.decode('utf8')
-print(f"My IP: {ip}")
-MY_IP = ip
+log = logging.getLogger(__name__)
 
-def download_piece(peer: Peer, piece_index: int, piece_length: int) -> bool:
+PIPELINE_DEPTH = 10 # Block requests kept in flight per peer
+MAX_CONNECT_WORKERS = 32 # Peers connected to and initialized at the same time
+PEER_CACHE_PATH = "file_pieces/.peers" # Peers of the last run, to reconnect to on resume
+PEER_CACHE_SIZE = 200
+
+IP_CACHE_PATH = os.path.expanduser("~/.pytorrent/ip")
+IP_CACHE_TTL = 3600 # Seconds the cached public IP is trusted
+
+def _get_public_ip():
     """
-    Download a single piece from a peer.
-    Returns True if the piece was successfully downloaded,
-    False otherwise.
+    Get our public IP, from the cache file if it's recent enough
+
+    :return: The IP address, or None if it can't be found
     """
-    block_size = 16 * 1024  # 16 KB blocks
-    cur_piece_length = 0
-    MAX_RETRIES = 3
+    try:
+        if time.time() - os.path.getmtime(IP_CACHE_PATH) < IP_CACHE_TTL:
+            with open(IP_CACHE_PATH) as f:
+                return f.read().strip()
+    except OSError:
+        pass
 
-    piece_path = f"file_pieces/{piece_index}.part"
-    # Pre-create the file with null data if it doesn't exist
-    if not os.path.exists(piece_path):
-        with open(piece_path, "wb") as f:
-            f.write(b"\x00" * piece_length)
+    try:
+        resp = get('https://api.ipify.org', timeout=2)
+        # Don't take an error page or a captive portal for our address
+        if not resp.ok:
+            log.warning("Public IP lookup failed: HTTP %d", resp.status_code)
+            return None
+        ip = str(ipaddress.ip_address(resp.content.decode('utf8').strip()))
+    except Exception as e:
+        log.warning("Public IP lookup failed: %s", e)
+        return None
 
-    for offset in range(0, piece_length, block_size):
-        length = min(block_size, piece_length - offset)
-        retries = 0
+    try:
+        os.makedirs(os.path.dirname(IP_CACHE_PATH), exist_ok=True)
+        with open(IP_CACHE_PATH, 'w') as f:
+            f.write(ip)
+    except OSError:
+        pass
+    return ip
 
-        while retries < MAX_RETRIES:
-            try:
-                peer.request_piece(piece_index, offset, length)
-                response = peer.recv()
+def _get_local_ips() -> set:
+    """
+    Addresses of our own network interfaces
+    """
+    ips = {"127.0.0.1"}
+    try:
+        ips.update(info[4][0] for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET))
+    except OSError:
+        pass
+    # Connecting a UDP socket picks the outgoing interface without sending anything
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("8.8.8.8", 80))
+            ips.add(s.getsockname()[0])
+    except OSError:
+        pass
+    return ips
+
+@functools.lru_cache(maxsize=None)
+def get_my_ips() -> frozenset:
+    """
+    All the addresses we may show up as in a tracker's peer list, for
+    filtering out self-connection. Looked up on first use and cached
+    """
+    ips = _get_local_ips()
+    public_ip = _get_public_ip()
+    if public_ip:
+        ips.add(public_ip)
+    return frozenset(ips)
+
+# macOS fcntl preallocation, see fcntl(2)
+F_PREALLOCATE = 42
+F_ALLOCATECONTIG = 0x2 # Allocate contiguous space
+F_ALLOCATEALL = 0x4 # Allocate all or nothing
+F_PEOFPOSMODE = 3 # Offset is relative to the physical end of file
+_FSTORE = struct.Struct('@IiqqQ') # fstore_t
+
+def _preallocate_darwin(fd: int, size: int) -> None:
+    """
+    Reserve disk space with F_PREALLOCATE, contiguous if possible
+    """
+    import fcntl
+    command = getattr(fcntl, "F_PREALLOCATE", F_PREALLOCATE)
+    for flags in (F_ALLOCATECONTIG | F_ALLOCATEALL, F_ALLOCATEALL):
+        try:
+            fcntl.fcntl(fd, command, _FSTORE.pack(flags, F_PEOFPOSMODE, 0, size, 0))
+            return
+        except OSError:
+            continue
+
+def preallocate(fd: int, size: int) -> None:
+    """
+    Reserve size bytes of disk space for the file, without writing any data.
+    Uses fallocate on Linux and F_PREALLOCATE on macOS, falls back to just
+    extending the file elsewhere
+    """
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as e:
+            # Filesystem without fallocate support
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+    elif sys.platform == "darwin":
+        _preallocate_darwin(fd, size)
+    # F_PREALLOCATE only reserves the space, the file size still has to be set
+    os.ftruncate(fd, size)
+
+def load_peer_cache(info_hash: bytes) -> list:
+    """
+    Load the peers we were connected to in the previous run of this torrent
+
+    :return: List of (ip, port), empty if there is no cache for this torrent
+    """
+    try:
+        with open(PEER_CACHE_PATH) as f:
+            cache = json.load(f)
+        if cache["info_hash"] != info_hash.hex():
+            return []
+        return [(ip, port) for ip, port in cache["peers"]]
+    except (OSError, ValueError, KeyError, TypeError):
+        return []
+
+def save_peer_cache(info_hash: bytes, peers) -> None:
+    """
+    Store the peers we are connected to, so the next run can reconnect to them
+    without waiting for the tracker
+    """
+    cache = {
+        "info_hash": info_hash.hex(),
+        "peers": [[peer.ip, peer.port] for peer in peers[:PEER_CACHE_SIZE]],
+    }
+    try:
+        with open(PEER_CACHE_PATH + ".tmp", 'w') as f:
+            json.dump(cache, f)
+        os.replace(PEER_CACHE_PATH + ".tmp", PEER_CACHE_PATH)
+    except OSError as e:
+        log.warning("Failed saving peer cache: %s", e)
+
+def create_piece_file(piece_index: int, piece_length: int) -> None:
+    """
+    Pre-create the piece file if it doesn't exist, reserving its blocks without writing zeros
+    """
+    try:
+        fd = os.open(f"file_pieces/{piece_index}.part", os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        return
+    try:
+        preallocate(fd, piece_length)
+    finally:
+        os.close(fd)
+
+def download_from_peer(peer: Peer, piece_manager: PieceManager) -> bool:
+    """
+    Download pieces from a peer until it has none we still need.
+    Returns True if the peer ran out of pieces to give us,
+    False if it stopped responding or sent bad data.
+
+    Up to PIPELINE_DEPTH block requests are kept in flight. The next piece is
+    started while the last blocks of the current one are still in flight, so
+    the pipeline doesn't drain at every piece boundary.
+    """
+    MAX_RETRIES = 3
 
-                if not response:
-                    print(f"No response for block at offset {offset}.")
-                    retries += 1
-                    continue
+    pending = deque() # (index, offset, length) of blocks not requested yet
+    in_flight = {} # (index, offset) -> length of requested blocks
+    remaining = {} # Blocks still to receive, per piece being downloaded
+    retries = 0
 
-                piece_msg = message.Message.deserialize(response)
-                
+    try:
+        while True:
+            # Start the next piece once all the blocks of the current one are requested
+            if not pending and len(in_flight) < PIPELINE_DEPTH:
+                # Use the pieces the peer announced, or assume the peer has all pieces.
+                # Only wait for pieces held by other peers when we have nothing else to do
+                piece_index = piece_manager.choose_next_piece(peer.have_mask, wait=not in_flight)
+                if piece_index is not None:
+                    piece = piece_manager.pieces[piece_index]
+                    create_piece_file(piece_index, piece.piece_length)
+                    # A piece that failed part way keeps its received blocks, only ask for the rest
+                    blocks = piece.missing_blocks()
+                    if not blocks:
+                        # All blocks are there but the piece was never verified, start over
+                        piece.flush()
+                        blocks = piece.missing_blocks()
+                    log.debug("Starting download of piece %d from %s:%d (%d of %d blocks)",
+                              piece_index, peer.ip, peer.port, len(blocks), piece.number_of_blocks)
+                    remaining[piece_index] = len(blocks)
+                    pending.extend((piece_index, offset, length) for offset, length in blocks)
+                elif not in_flight:
+                    log.info("No available piece for peer %s:%d", peer.ip, peer.port)
+                    return True
 
-                if isinstance(piece_msg, message.Piece):
-                    peer.handle_piece(piece_msg)
-                    cur_piece_length += len(piece_msg.block)
-                    break  # Successfully received block, move to next block
-                else:
-                    print(f"Got unexpected message type {type(piece_msg)}; retrying...")
-                    retries += 1
+            # Keep PIPELINE_DEPTH requests outstanding instead of waiting a round trip per block
+            bursts = {}
+            while pending and len(in_flight) < PIPELINE_DEPTH:
+                piece_index, offset, length = pending.popleft()
+                bursts.setdefault(piece_index, []).append((offset, length))
+                in_flight[piece_index, offset] = length
+            for piece_index, blocks in bursts.items():
+                peer.request_blocks(piece_index, blocks)
 
+            try:
+                response = peer.recv()
+            except ConnectionError:
+                raise # Retrying won't help, see below
             except socket.error as e:
-                print(f"Socket error while downloading: {e}")
+                log.warning("Socket error while downloading: %s", e)
+                response = None
+
+            if response is None:
                 retries += 1
+                if retries == MAX_RETRIES:
+                    log.warning("Peer %s:%d stopped responding, %d blocks still missing",
+                                peer.ip, peer.port, len(in_flight) + len(pending))
+                    return False
+                log.info("No response for %d requested blocks; requesting them again...", len(in_flight))
+                bursts = {}
+                for piece_index, offset in in_flight:
+                    bursts.setdefault(piece_index, []).append((offset, in_flight[piece_index, offset]))
+                for piece_index, blocks in bursts.items():
+                    peer.request_blocks(piece_index, blocks)
+                continue
+            if not response:
+                continue # Keep-alive
 
-        if retries == MAX_RETRIES:
-            print(f"Failed to download block at offset {offset}")
-            try:
-                os.remove(piece_path)
-            except OSError:
-                pass
-            return False
+            piece_msg = message.Message.deserialize(response)
 
-    if cur_piece_length < piece_length:
-        print(f"Piece {piece_index} incomplete (downloaded {cur_piece_length} of {piece_length}). Removing file.")
-        try:
-            os.remove(piece_path)
-        except OSError:
-            pass
+            if not isinstance(piece_msg, message.Piece):
+                # Have, Choke, ... keep the peer state up to date during the download
+                peer.handle_message(piece_msg)
+            elif (piece_msg.index, piece_msg.begin) in in_flight:
+                del in_flight[piece_msg.index, piece_msg.begin]
+                retries = 0
+                if not peer.handle_piece(piece_msg):
+                    # The block doesn't fit what we requested, so the piece would never
+                    # complete. Drop the peer, its pieces go back to the other peers
+                    log.warning("Peer %s:%d sent a bad block for piece %d",
+                                peer.ip, peer.port, piece_msg.index)
+                    return False
+                remaining[piece_msg.index] -= 1
+                if not remaining[piece_msg.index]:
+                    del remaining[piece_msg.index]
+                    log.debug("✅ Successfully downloaded piece %d", piece_msg.index)
+            else:
+                log.debug("Got an unrequested block of piece %d; ignoring", piece_msg.index)
+    except ConnectionError as e:
+        # Closed connection or a broken message, while receiving or sending requests
+        log.warning("Dropping peer %s:%d: %s", peer.ip, peer.port, e)
         return False
-
-    return True
+    finally:
+        # Unfinished pieces go back to the other peers, with the blocks received so far
+        for piece_index in remaining:
+            log.warning("❌ Failed to download piece %d from %s:%d", piece_index, peer.ip, peer.port)
+            piece_manager.release_piece(piece_index, failed=True)
 
 def initialize_peer(peer: Peer) -> bool:
     """
-    Initialize connection with a peer.
-    Returns True if initialization (e.g. unchoking) is successful.
+    Setup the connection for piece requesting, using the following steps:
+
+    1. Send Interested
+    2. Start Listening for Unchoke and Bitmap/Have messages
+
+    Returns True once the peer unchoked us and we know which pieces it has.
     """
     try:
-        print(f"Initializing connection with {peer.ip}:{peer.port}")
-        # Send interested message immediately
+        log.debug("Initializing connection with %s:%d", peer.ip, peer.port)
         peer.send(message.Interested())
-        print("Sent interested message")
 
-        # Wait for an Unchoke or a Bitfield
         while True:
-            response = peer.recv()
-            response_message = message.Message.deserialize(response)
+            response_message = message.Message.deserialize(peer.recv())
+            peer.handle_message(response_message)
             
-            if isinstance(response_message, message.Unchoke):
-                print("Peer unchoked us. Ready to request pieces.")
+            if not peer.is_choking() and peer.bitfield is not None:
+                log.debug("Peer %s:%d unchoked us and sent its pieces.", peer.ip, peer.port)
                 return True
-            elif isinstance(response_message, message.Bitfield):
-                print("Received Bitfield; waiting for unchoke.")
-                peer.bitfield = response_message.bitfield
-                continue
-            elif isinstance(response_message, message.Have):
-                print("Received Have message; still waiting for unchoke.")
-                continue
-            else:
-                print(f"Unexpected message: {type(response_message)}")
-                continue
-    except socket.error as e:
-        print(f"Connection error during initialization: {e}")
-        return False
+    
+    except Exception as e:
+        log.info("Error initializing peer %s:%d: %s", peer.ip, peer.port, e)
+    return False
 
 class PeerManager:
-    def __init__(self, tracker: TrackerHandler, piece_manager: PieceManager, my_ip):
+    def __init__(self, tracker: TrackerHandler, piece_manager: PieceManager, my_ips):
         self.tracker = tracker
         self.piece_manager = piece_manager
-        self.my_ip = my_ip
+        self.my_ips = my_ips
         self.peers = []
     
 
-    def add_peers(self):
-        # Create Peer instances from tracker response
-        for peer_info in self.tracker.peers_list:
-            if peer_info[0] == self.my_ip:
-                print("Skipping self.")
+    def add_peers(self, peer_list=None):
+        # Create Peer instances from tracker response, or from the given (ip, port) list
+        if peer_list is None:
+            peer_list = self.tracker.peers_list
+        known = {(peer.ip, peer.port) for peer in self.peers}
+        peer_infos = []
+        for peer_info in peer_list:
+            if peer_info[0] in self.my_ips:
+                log.debug("Skipping self.")
                 continue
-            
-            try:
-                new_peer = Peer(peer_info[0],
-                            peer_info[1],
-                            self.tracker.info_hash,
-                            self.tracker.peer_id, self.piece_manager
-                )
-                new_peer.connect()
-
-                if new_peer.healthy:
+            if tuple(peer_info) in known:
+                continue # Already connected, e.g. from the peer cache
+            known.add(tuple(peer_info))
+            peer_infos.append(peer_info)
+
+        # Connecting is mostly waiting on the network, so connect to all the peers at once
+        with ThreadPoolExecutor(max_workers=MAX_CONNECT_WORKERS) as executor:
+            for new_peer in executor.map(self._connect_peer, peer_infos):
+                if new_peer is not None:
                     self.peers.append(new_peer)
-                else:
-                    print(f"Peer {peer_info[0]}:{peer_info[1]} not healthy, skipping.")
-            except Exception as e:
-                print(f"Error connecting to peer {peer_info}: {e}")
+
+    def _connect_peer(self, peer_info):
+        """
+        Connect and handshake with a peer
+
+        :return: The connected Peer, None if the connection failed
+        """
+        try:
+            new_peer = Peer(peer_info[0],
+                        peer_info[1],
+                        self.tracker.info_hash,
+                        self.tracker.peer_id, self.piece_manager
+            )
+            new_peer.connect()
+
+            if new_peer.healthy:
+                return new_peer
+            log.info("Peer %s:%d not healthy, skipping.", peer_info[0], peer_info[1])
+        except Exception as e:
+            log.info("Error connecting to peer %s: %s", peer_info, e)
+        return None
 
     def initialize_peers(self):
-        # Initialize all peers (send interested and handle bitfield+unchoke)
+        # Initialize all peers (send interested and handle bitfield+unchoke), in parallel
+        with ThreadPoolExecutor(max_workers=MAX_CONNECT_WORKERS) as executor:
+            results = list(executor.map(initialize_peer, self.peers))
+
         healthy_peers = []
-        for peer in self.peers:
-            if self._initialize_peer(peer):
+        for peer, initialized in zip(self.peers, results):
+            if initialized:
                 healthy_peers.append(peer)
             else:
-                print(f"Initialization failed for peer {peer.ip}:{peer.port}")
+                log.info("Initialization failed for peer %s:%d", peer.ip, peer.port)
         self.peers = healthy_peers
 
-    def _initialize_peer(self, peer: Peer):
+    def download_pieces(self):
+        # Every peer downloads in its own thread, so different pieces come from all peers at once
+        peers = self.peers[:]
+        if peers:
+            with ThreadPoolExecutor(max_workers=len(peers)) as executor:
+                executor.map(self._peer_worker, peers)
+        log.info("All available pieces have been processed. Download complete.")
+
+    def _peer_worker(self, peer: Peer):
         """
-        Setup the connection for piece requesting, using the following steps:
-        
-        1. Send Interested
-        2. Start Listening for Unchoke and Bitmap/Have messages
+        Download pieces from a single peer until it has none we still need, or it fails
         """
         try:
-            print(f"Initializing connection with {peer.ip}:{peer.port}")
-            peer.send(message.Interested())
-
-            while True:
-                response = peer.recv()
-                response_message = message.Message.deserialize(response)
-                
-                if isinstance(response_message, message.Unchoke):
-                    peer.handle_unchoke()
-                    print(f"Peer {peer.ip}:{peer.port} unchoke us.")
-                elif isinstance(response_message, message.Bitfield):
-                    peer.handle_bitfield(response_message)
-                    print(f"Peer {peer.ip}:{peer.port} sent Bitfield.")
-                elif isinstance(response_message, message.Have):
-                    peer.handle_have(response_message)
-                
-                if not peer.is_choking() and peer.bitfield is not None:
-                    return True
-        
+            downloaded = download_from_peer(peer, self.piece_manager)
         except Exception as e:
-            print(f"Error initializing peer {peer.ip}:{peer.port}: {e}")
-        return False
-    
-    def download_pieces(self):
-        # Main loop to assign pieces to peers until no assignments can be made.
-        while True:
-            assignment_made = False
-            for peer in self.peers[:]:
-                # Use peer.bitfield if available, or assume the peer has all pieces.
-                peer_bitfield = peer.bitfield if peer.bitfield is not None else None
-                next_piece_idx = self.piece_manager.choose_next_piece(peer_bitfield)
-                if next_piece_idx is not None:
-                    assignment_made = True
-                    expected_length = self.piece_manager.pieces[next_piece_idx].piece_length
-                    print(f"\nStarting download of piece {next_piece_idx} from {peer.ip}:{peer.port}")
-                    if download_piece(peer, next_piece_idx, expected_length):
-                        print(f"✅ Successfully downloaded piece {next_piece_idx}")
-                    else:
-                        print(f"❌ Failed to download piece {next_piece_idx} from {peer.ip}:{peer.port}")
-                        self.piece_manager.release_piece(next_piece_idx)
-                        self.peers.remove(peer)
-                else:
-                    print(f"No available piece for peer {peer.ip}:{peer.port}")
-            if not assignment_made:
-                break
-            time.sleep(1)  # Small delay to avoid a tight loop
-        print("All available pieces have been processed. Download complete.")
+            log.warning("Error downloading from %s:%d: %s", peer.ip, peer.port, e)
+            downloaded = False
+        if not downloaded:
+            self.peers.remove(peer)
 
 
 def main(torrent_path: str) -> None:
@@ -215,18 +393,31 @@ def main(torrent_path: str) -> None:
     tracker_h = TrackerHandler(tor)
     piece_manager = PieceManager(tor)
     
-    tracker_h.send_request()
-    print(f"Tracker response: {tracker_h.response}\n")
-    
-    peer_manager = PeerManager(tracker_h, piece_manager, MY_IP)
+    my_ips = get_my_ips()
+    print(f"My IPs: {', '.join(sorted(my_ips))}")
+    peer_manager = PeerManager(tracker_h, piece_manager, my_ips)
+
+    # Reconnect to the peers of the previous run while the tracker request is in flight
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        tracker_request = executor.submit(tracker_h.send_request)
+        peer_manager.add_peers(load_peer_cache(tor.info_hash))
+        tracker_request.result()
+    print(f"Tracker response: {getattr(tracker_h, 'response', None)}\n")
+
     peer_manager.add_peers()
     peer_manager.initialize_peers()
+    save_peer_cache(tor.info_hash, peer_manager.peers)
     peer_manager.download_pieces()
+    piece_manager.close()
     
-    print(f"Attempted to download all {tor.total_pieces} pieces")
+    if piece_manager.is_complete():
+        print(f"Downloaded all {tor.total_pieces} pieces")
+    else:
+        print(f"Attempted to download all {tor.total_pieces} pieces ({piece_manager.get_progress():.2f}% done)")
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     if len(sys.argv) != 2:
         print("Usage: python main.py <torrent_file>")
         sys.exit(1)
@@ -1,4 +1,13 @@
-import bitstring
+import bitfield
+import struct
+import logging
+
+log = logging.getLogger(__name__)
+
+# Request message: length prefix, message ID, index, begin, length
+_REQUEST = struct.Struct('>IBIII')
+# Piece message payload header: index, begin
+_PIECE_HEADER = struct.Struct('>II')
 
 class Message:
     # A mapping of all message types to their respective IDs
@@ -17,12 +26,13 @@ class Message:
             message_id = data[0]
             message_map = cls._build_message_map()
             message_class = message_map.get(message_id)
-            print(f"Deserializng message: {message_class}, {message_id}")
+            log.debug("Deserializng message: %s, %s", message_class, message_id)
             if not message_class:
                 raise ValueError(f"Invalid message ID: {message_id}")
-            return message_class.deserialize_payload(data[1:])
+            # Payloads are views into data, so the block of a Piece isn't copied
+            return message_class.deserialize_payload(memoryview(data)[1:])
         except Exception as e:
-            print(f"Error deserializing message: {e}")
+            log.warning("Error deserializing message: %s", e)
     def deserialize_payload(self, data):
         raise NotImplementedError
 
@@ -64,7 +74,7 @@ class Choke(Message):
     
     @classmethod
     def deserialize_payload(cls, data):
-        return Unchoke()
+        return Choke()
 
 
 class Unchoke(Message):
@@ -140,8 +150,7 @@ class Bitfield(Message):
 
     @classmethod
     def deserialize_payload(self, data):
-        bitfield = bitstring.BitArray(data)
-        return Bitfield(bitfield)
+        return Bitfield(bitfield.Bitfield(data))
 
     def __str__(self):
         return f"Bitfield: {self.bitfield}"
@@ -157,14 +166,20 @@ class Request(Message):
         self.length = length
 
     def serialize(self):
-        payload = (
-            self.index.to_bytes(4, byteorder='big') +
-            self.begin.to_bytes(4, byteorder='big') +
-            self.length.to_bytes(4, byteorder='big')
-        )
-        message_length = (1 + len(payload)).to_bytes(4, byteorder='big')
+        return _REQUEST.pack(_REQUEST.size - 4, self.message_id, self.index, self.begin, self.length)
 
-        return message_length + bytes([self.message_id]) + payload
+    @classmethod
+    def serialize_many(cls, index, blocks) -> bytearray:
+        """
+        Serialize requests for several blocks of a piece into one buffer,
+        without creating a Request object per block
+
+        :param blocks: List of (begin, length) tuples
+        """
+        buffer = bytearray(_REQUEST.size * len(blocks))
+        for i, (begin, length) in enumerate(blocks):
+            _REQUEST.pack_into(buffer, i * _REQUEST.size, _REQUEST.size - 4, cls.message_id, index, begin, length)
+        return buffer
 
 class Piece(Message):
     message_id = 7
@@ -176,9 +191,8 @@ class Piece(Message):
     
     @classmethod
     def deserialize_payload(cls, data):
-        index = int.from_bytes(data[:4], 'big')
-        begin = int.from_bytes(data[4:8], 'big')
-        block = data[8:]
+        index, begin = _PIECE_HEADER.unpack_from(data)
+        block = data[_PIECE_HEADER.size:]
         return Piece(index, begin, block)
 
 
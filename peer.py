@@ -1,8 +1,21 @@
 import socket
+import struct
+import logging
 from message import Message
 import message
-from network import recv_by_size
 from piece_manager import PieceManager
+from bitfield import Bitfield
+from piece import BLOCK_SIZE
+
+log = logging.getLogger(__name__)
+
+# Length prefix of every peer message
+_LEN = struct.Struct('>I')
+# Receive buffer size, room for several Piece messages with a full block
+RECV_BUFFER_SIZE = 16 * (BLOCK_SIZE + 13)
+# Largest message accepted apart from the Bitfield, a Piece message with a full block
+MAX_MESSAGE_SIZE = BLOCK_SIZE + 13
+
 class Peer:
     # Temporary refernce to Piece manager, Until i make an event-based system 
     def __init__(self, ip : str, port : int, info_hash, peer_id, piece_manager: PieceManager) -> None:
@@ -19,7 +32,17 @@ class Peer:
         }
         self.healthy = True
         self.bitfield = None
+        self.have_mask = None # Bitmap of the pieces the peer has, see PieceManager.bitfield_mask
         self.piece_manager = piece_manager
+        # Received data not yet returned by recv() is _rxbuf[_rxstart:_rxend]
+        self._rxbuf = bytearray(RECV_BUFFER_SIZE)
+        self._rxview = memoryview(self._rxbuf)
+        self._rxstart = 0
+        self._rxend = 0
+        # A bogus length prefix must not make us allocate gigabytes
+        self._max_message = MAX_MESSAGE_SIZE
+        if piece_manager is not None:
+            self._max_message = max(MAX_MESSAGE_SIZE, (piece_manager.number_of_pieces + 7) // 8 + 1)
 
     
     def connect(self):
@@ -30,15 +53,17 @@ class Peer:
         # self.sock.connect((self.ip, self.port))
         try:
             self.sock = socket.create_connection((self.ip, self.port), timeout=1)
-            print(f"Connected to {self.ip}:{self.port}")
+            # Send small messages (requests, haves) right away instead of waiting for Nagle's algorithm
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            log.info("Connected to %s:%d", self.ip, self.port)
             # Perform handshake
             self._send_handshake()
             response = self._recv_handshake()
             parsed_response = self._parse_handshake(response)
             
             
-            print(f"Raw response: {response}")
-            print(f'Parsed response: {parsed_response}\n')
+            log.debug("Raw response: %s", response)
+            log.debug("Parsed response: %s", parsed_response)
 
         
         except socket.error as e:
@@ -102,11 +127,22 @@ class Peer:
         """
         request_message = message.Request(index, begin, length)
         self.send(request_message)
-        print(f"Sent request for piece {index} at {begin} with length {length}")
+        log.debug("Sent request for piece %d at %d with length %d", index, begin, length)
+
+    def request_blocks(self, index, blocks):
+        """
+        Send requests for several blocks of a piece with a single write,
+        so a burst of requests goes out in as few packets as possible
 
-    def handle_piece(self, piece: message.Piece):
+        :param blocks: List of (begin, length) tuples
         """
-        Handle and process the piece data
+        self.sock.sendall(message.Request.serialize_many(index, blocks))
+        log.debug("Sent %d requests for piece %d", len(blocks), index)
+
+    def handle_piece(self, piece: message.Piece) -> bool:
+        """
+        Handle and process the piece data.
+        Returns False if the block was not used
         """
         # idx = piece.index
         # block_offset = piece.begin
@@ -114,9 +150,10 @@ class Peer:
         # with open(f"file_pieces/{idx}.part", "r+b") as f:
         #     f.seek(block_offset)
         #     f.write(piece.block)
-        print(f"📥 Received block for piece {piece.index} at offset {piece.begin}")
-        print(f"Last 20 bytes of data{piece.block[-20:]}")
-        self.piece_manager.recieve_block_piece(piece.index, piece.begin, piece.block)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("📥 Received block for piece %d at offset %d", piece.index, piece.begin)
+            log.debug("Last 20 bytes of data%s", bytes(piece.block[-20:]))
+        return self.piece_manager.recieve_block_piece(piece.index, piece.begin, piece.block)
     
     def send(self, message):
         """
@@ -130,7 +167,46 @@ class Peer:
             raise ValueError("Invalid message object.")
 
     def recv(self):
-        return recv_by_size(self.sock)
+        """
+        Receive a single length prefixed message from the peer's receive buffer.
+        The buffer is filled with as much as the socket has ready, so a single
+        recv_into usually brings in several messages
+
+        :return: A memoryview of the message, only valid until the next recv() call
+        """
+        while True:
+            available = self._rxend - self._rxstart
+            needed = _LEN.size
+            if available >= _LEN.size:
+                (size,) = _LEN.unpack_from(self._rxbuf, self._rxstart)
+                if size > self._max_message:
+                    raise ConnectionError(f"Message of {size} bytes from {self.ip}:{self.port} is too big")
+                needed += size
+                if available >= needed:
+                    start = self._rxstart + _LEN.size
+                    self._rxstart += needed
+                    return self._rxview[start:start + size]
+            self._fill(needed)
+
+    def _fill(self, needed):
+        """
+        Read from the socket into the free end of the receive buffer,
+        making room for a message of needed bytes first
+        """
+        if self._rxstart + needed > len(self._rxbuf):
+            pending = self._rxbuf[self._rxstart:self._rxend]
+            if needed > len(self._rxbuf):
+                # Bigger than the buffer, e.g. the Bitfield of a huge torrent
+                self._rxbuf = bytearray(max(needed, len(self._rxbuf) * 2))
+                self._rxview = memoryview(self._rxbuf)
+            # Move the partial message to the start of the buffer
+            self._rxbuf[:len(pending)] = pending
+            self._rxstart, self._rxend = 0, len(pending)
+
+        n = self.sock.recv_into(self._rxview[self._rxend:])
+        if not n:
+            raise ConnectionError(f"Connection closed by {self.ip}:{self.port}")
+        self._rxend += n
     
     def is_choking(self):
         return self.state['peer_choking']
@@ -152,10 +228,35 @@ class Peer:
     
     def handle_bitfield(self, bitfield: message.Bitfield):
         self.bitfield = bitfield.bitfield
+        self.have_mask = self.piece_manager.bitfield_mask(self.bitfield.tobytes())
     
     def handle_have(self, have: message.Have):
         if self.bitfield is None:
             total_pieces = self.piece_manager.number_of_pieces
-            self.bitfield = [0] * total_pieces
+            self.bitfield = Bitfield.zeros(total_pieces)
+        if self.have_mask is None:
+            self.have_mask = 0
         # Update the bitfield to indicate the peer has this piece
         self.bitfield[have.index] = 1
+        self.have_mask |= self.piece_manager.piece_bit(have.index)
+
+    def handle_message(self, msg):
+        """
+        Update the peer state from a received message, looking up its handler
+        by message ID instead of testing the message type against each handler
+
+        :param msg: A deserialized message, None is ignored
+        """
+        handler = _HANDLERS.get(getattr(msg, 'message_id', None))
+        if handler is not None:
+            handler(self, msg)
+
+
+# Handler of each message type, by message ID.
+# Piece messages are matched against the requested blocks by the download loop
+_HANDLERS = {
+    message.Choke.message_id: lambda peer, msg: peer.handle_choke(),
+    message.Unchoke.message_id: lambda peer, msg: peer.handle_unchoke(),
+    message.Have.message_id: Peer.handle_have,
+    message.Bitfield.message_id: Peer.handle_bitfield,
+}
@@ -1,19 +1,75 @@
+import sha1_accel
+
+BLOCK_SHIFT = 14
+BLOCK_SIZE = 1 << BLOCK_SHIFT # Size of the blocks requested from peers (16 KB)
+BLOCK_MASK = BLOCK_SIZE - 1
+
 class Piece:
     def __init__(self, piece_index: int, piece_length: int, piece_hash):
         self.piece_index: int = piece_index
         self.piece_length: int = piece_length
-        self.piece_hash: bytes = piece_hash
-        self.raw_data: bytes = b'' # Store downloaded data
+        self.piece_hash: memoryview = piece_hash # View into the torrent's hash buffer
+        self.number_of_blocks: int = (piece_length + BLOCK_MASK) >> BLOCK_SHIFT
+        self.raw_data: bytearray = None # Store downloaded data, allocated on the first block
+        self.received_bytes: int = 0
+        self._received = bytearray(self.number_of_blocks) # One flag per block
+        self._hasher = sha1_accel.sha1() # Running hash of raw_data
+        self._hashed: int = 0 # Length of the prefix fed to the hasher
+
+    def add_block(self, offset: int, data):
+        """
+        Copy a block into its place in the piece, and hash it as soon as all
+        the data before it arrived.
+        Returns False if the block doesn't fit the piece or was already received
+        """
+        block_index = offset >> BLOCK_SHIFT
+        if offset & BLOCK_MASK or block_index >= self.number_of_blocks:
+            return False
+        if len(data) != min(BLOCK_SIZE, self.piece_length - offset):
+            return False
+        if self._received[block_index]:
+            return False # Already have this block
+
+        if self.raw_data is None:
+            self.raw_data = bytearray(self.piece_length)
+        self.raw_data[offset:offset + len(data)] = data
+        self._received[block_index] = 1
+        self.received_bytes += len(data)
 
-    def add_block(self, data):
-        """Store a block"""
-        self.raw_data += data
+        if offset == self._hashed:
+            self._hash_received_prefix()
+        return True
+
+    def _hash_received_prefix(self):
+        view = memoryview(self.raw_data)
+        while self._hashed < self.piece_length and self._received[self._hashed >> BLOCK_SHIFT]:
+            end = min(self._hashed + BLOCK_SIZE, self.piece_length)
+            self._hasher.update(view[self._hashed:end])
+            self._hashed = end
+
+    def missing_blocks(self) -> list:
+        """
+        (offset, length) of the blocks not received yet
+        """
+        return [
+            (block_index << BLOCK_SHIFT, min(BLOCK_SIZE, self.piece_length - (block_index << BLOCK_SHIFT)))
+            for block_index, received in enumerate(self._received)
+            if not received
+        ]
 
     def is_complete(self):
-        return len(self.raw_data) == self.piece_length
+        return self.received_bytes == self.piece_length
+
+    def digest(self) -> bytes:
+        """SHA1 of the data received so far"""
+        return self._hasher.digest()
     
     def flush(self):
         """
         Reset the data in case of a download failure
         """
-        self.raw_data = b''
+        self.raw_data = None
+        self.received_bytes = 0
+        self._received = bytearray(self.number_of_blocks)
+        self._hasher = sha1_accel.sha1()
+        self._hashed = 0
@@ -1,102 +1,413 @@
 from piece import Piece
+from bitfield import Bitfield
 from torrent import Torrent
+from sha1_accel import sha1_digest
 import typing 
-import hashlib
+import logging
+import array
 import os
+import mmap
+import time
+import random
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# Factor applied to a piece's selection weight every time its download fails
+PRIORITY_DECAY = 0.8
+# Selection weight of a piece by its number of failed attempts
+_BACKOFF = [PRIORITY_DECAY ** k for k in range(256)]
+
+RESUME_PATH = "file_pieces/.resume"
+RESUME_SAVE_INTERVAL = 5 # Seconds between resume file updates
+PROGRESS_LOG_STEP = 1.0 # Log progress every time it grows by this many percent
+PIECE_WAIT_TIMEOUT = 5 # Seconds a peer waits for a piece before checking again
+MAX_PICK_TRIES = 32 # Random picks before settling for a piece that failed before
+WRITE_QUEUE_SIZE = 64 # Verified pieces waiting for the writer before receivers block
 
 class PieceManager:
     def __init__(self, torrent: Torrent):
         self.pieces: typing.List[Piece] = []
         self.busy_pieces = set()
+        self.completed_pieces = set()
         self.torrent = torrent
         self.number_of_pieces = torrent.total_pieces
+        # Pieces we have, one bit per piece (MSB first, like the Bitfield message)
+        self.bitfield = Bitfield.zeros(self.number_of_pieces)
+        # Expected hashes of all pieces, as one contiguous buffer of 20 byte digests
+        self._hash_blob = memoryview(bytes(torrent.pieces))
+        # Identifies the torrent in the resume file
+        self._info_hash = torrent.info_hash
+        self._last_resume_save = 0.0
+        self._resume_dirty = False # Pieces completed since the last resume save
+        self._progress_next_log = 0.0
+        # Guards piece selection across peer threads, notified whenever a
+        # busy piece is released or completed
+        self._changed = threading.Condition()
 
         self._generate_pieces()
 
-        # Load expected hashes from the torrent metadata
-        self.expected_hashes = [
-            torrent.pieces[i * 20:(i + 1) * 20]
-            for i in range(torrent.total_pieces)
-        ]
+        self._load_completed_pieces()
+
+        # Pieces free to be chosen (available and not busy) as an int bitmap.
+        # Piece i is bit (_mask_bits - 1 - i), the layout of the Bitfield bytes,
+        # so a peer's bitfield converts to the same layout with int.from_bytes
+        self._mask_bits = len(self.bitfield)
+        self._all_mask = ((1 << self.number_of_pieces) - 1) << (self._mask_bits - self.number_of_pieces)
+        self._free_mask = 0
+        for piece_index in self.available:
+            self._free_mask |= self.piece_bit(piece_index)
+
+        # Verified pieces are written to disk by a background thread, so the
+        # receiving side doesn't wait on disk latency. The queue is bounded so
+        # a disk slower than the network slows the peers down, instead of
+        # piling up piece buffers in memory
+        self._write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self._writer = threading.Thread(target=self._write_worker, daemon=True)
+        self._writer.start()
 
-    def recieve_block_piece(self, piece_index, piece_offset, piece_data):
+    def recieve_block_piece(self, piece_index, piece_offset, piece_data) -> bool:
+        """
+        Store a received block, and check and write the piece once it is complete.
+        Returns False if the block was not used
+        """
         # piece_index, piece_offset, piece_data = piece
-        piece:Piece = self.pieces[piece_index]
+        if piece_index not in self.available:
+            return False # Late block of a piece that is already verified
 
-        piece.add_block(piece_data)
+        piece:Piece = self.pieces[piece_index]
+        if not piece.add_block(piece_offset, piece_data):
+            log.debug("Rejected block of piece %d at offset %d", piece_index, piece_offset)
+            return False
 
         if piece.is_complete():
-            print("✅ Download completed! Checking validity...")
+            log.debug("Piece %d downloaded, checking validity", piece_index)
             # Validate the piece integrity
             if self._validate_piece(piece):
-                print(f"✅ Piece {piece_index} completed and verified! Writing to disk...")
-                with open(f"file_pieces/{piece_index}.part", 'wb') as f:
-                    f.write(piece.raw_data)
-                self.busy_pieces.remove(piece_index)
-                
+                log.debug("✅ Piece %d verified, writing to disk", piece_index)
+                # The piece stays busy until the writer has stored it.
+                # The writer owns the buffer from here, the piece lets go of it
+                # so it is freed as soon as it's on disk. The piece is reset
+                # before queueing, so it is clean if a failed write makes it
+                # available again
+                self.available.discard(piece_index)
+                data = piece.raw_data
+                piece.flush()
+                self._write_queue.put((piece_index, data))
+
             else: 
-                print(f"❌ Hash mismatch for piece {piece_index}. Retrying...")
+                log.warning("❌ Hash mismatch for piece %d. Retrying...", piece_index)
                 piece.flush() # Reset piece and redownload
                 # Release the piece even if unsuccessful 
-                self.busy_pieces.remove(piece_index)
-        else:
-            print(f"Download not complete, current data:{len(piece.raw_data)}")
+                self.release_piece(piece_index, failed=True)
+        return True
+
+
+    def _write_worker(self):
+        """
+        Write verified pieces to disk as they are queued, until close() is called.
+        Everything queued since the last wakeup is handled as one batch
+        """
+        running = True
+        while running:
+            # Wake up periodically so pending resume data is saved even when
+            # no more pieces arrive
+            try:
+                batch = [self._write_queue.get(timeout=RESUME_SAVE_INTERVAL)]
+            except queue.Empty:
+                batch = []
+            while True:
+                try:
+                    batch.append(self._write_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            written = 0
+            for item in batch:
+                if item is None:
+                    running = False
+                    continue
+                piece_index, data = item
+                try:
+                    self._write_piece(piece_index, data)
+                    self._mark_completed(piece_index)
+                    written += 1
+                    self.busy_pieces.discard(piece_index)
+                except OSError as e:
+                    log.error("❌ Failed writing piece %d to disk: %s", piece_index, e)
+                    with self._changed:
+                        self.available.add(piece_index)
+                        self.busy_pieces.discard(piece_index)
+                        self._free_mask |= self.piece_bit(piece_index)
+
+            if batch:
+                with self._changed:
+                    self._changed.notify_all()
 
+            if written:
+                progress = self.get_progress()
+                if progress >= self._progress_next_log:
+                    log.info("Progress: %.2f%%", progress)
+                    self._progress_next_log = progress + PROGRESS_LOG_STEP
+                self._resume_dirty = True
+
+            if self._resume_dirty and time.monotonic() - self._last_resume_save >= RESUME_SAVE_INTERVAL:
+                self._save_resume()
+
+    def _write_piece(self, piece_index, data):
+        """
+        Write a piece over its placeholder file with a single positional write.
+        The file is not truncated, so the blocks reserved by the placeholder are reused
+        """
+        fd = os.open(f"file_pieces/{piece_index}.part", os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            view = memoryview(data)
+            written = 0
+            # pwrite may store less than asked, e.g. when the disk is full
+            while written < len(view):
+                n = os.pwrite(fd, view[written:], written)
+                if not n:
+                    raise OSError(f"Short write of piece {piece_index}: {written} of {len(view)} bytes")
+                written += n
+            os.ftruncate(fd, len(data))
+        finally:
+            os.close(fd)
+
+    def close(self):
+        """
+        Wait for all queued pieces to be written to disk
+        """
+        self._write_queue.put(None)
+        self._writer.join()
+        self._save_resume()
+
+    def _load_resume(self):
+        """
+        Load the resume file written by a previous run
+
+        :return: (bitfield, save time in ns) or None if missing or for another torrent
+        """
+        try:
+            with open(RESUME_PATH, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        # Format: info_hash (20 bytes) | save time in ns (8 bytes) | bitfield
+        if len(data) != 28 + len(self.bitfield) // 8 or data[:20] != self._info_hash:
+            return None
+        saved_ns = int.from_bytes(data[20:28], 'big')
+        return Bitfield(data[28:]), saved_ns
+
+    def _save_resume(self):
+        """
+        Store the bitfield so the next run doesn't need to re-hash the pieces
+        written before this point
+        """
+        self._last_resume_save = time.monotonic()
+        self._resume_dirty = False
+        data = self._info_hash + time.time_ns().to_bytes(8, 'big') + self.bitfield.bytes
+        try:
+            with open(RESUME_PATH + ".tmp", 'wb') as f:
+                f.write(data)
+            os.replace(RESUME_PATH + ".tmp", RESUME_PATH)
+        except OSError as e:
+            log.warning("Failed saving resume data: %s", e)
 
     def _generate_pieces(self):
         last_piece = self.number_of_pieces - 1
         piece_length = self.torrent.piece_length
-        for i in range(self.number_of_pieces):
-            start = i * 20
-            end = start + 20
+        last_piece_length = self.torrent.file_length - last_piece * piece_length
+        hashes = self._hash_blob
+
+        # Slicing the memoryview shares the torrent's buffer instead of copying each hash
+        self.pieces.extend(
+            Piece(i, piece_length, hashes[i * 20:(i + 1) * 20])
+            for i in range(last_piece)
+        )
+        # Pieces that still need to be downloaded, kept in sync on completion
+        self.available = set(range(last_piece))
 
-            if i == last_piece:
-                piece_length = self.torrent.file_length - (self.number_of_pieces - 1) * self.torrent.piece_length
+        if self.number_of_pieces:
+            self.pieces.append(Piece(last_piece, last_piece_length, hashes[last_piece * 20:]))
+            if last_piece_length > 0:
+                self.available.add(last_piece)
+
+        # Failed download attempts of each piece, saturating at 255
+        self.failed_attempts = array.array('B', bytes(self.number_of_pieces))
 
-            self.pieces.append(Piece(i, piece_length, self.torrent.pieces[start:end]))
-        
     def _validate_piece(self, piece: Piece):
-        actual_hash = hashlib.sha1(piece.raw_data).digest()
-        return actual_hash == piece.piece_hash
+        # The piece hashes its blocks as they arrive, no need to re-hash raw_data
+        return piece.digest() == piece.piece_hash
     
-    def is_piece_downloaded(self, piece: Piece) -> bool:
+    def _scan_piece_files(self) -> dict:
         """
-        Checks if the file {index}.part exists, and if it exists, verify the contents
+        Find the existing {index}.part files with a single directory scan
+
+        :return: A dictionary mapping piece index to the file's stat result
         """
-        piece_path = f"file_pieces/{piece.piece_index}.part"
-        if not os.path.exists(piece_path):
-            return False
-        
-        with open(piece_path, 'rb') as f:
-            data = f.read()
+        existing = {}
+        try:
+            with os.scandir("file_pieces") as entries:
+                for entry in entries:
+                    name, ext = os.path.splitext(entry.name)
+                    if ext != ".part" or not name.isdigit():
+                        continue
+                    if int(name) < self.number_of_pieces:
+                        existing[int(name)] = entry.stat(follow_symlinks=False)
+        except FileNotFoundError:
+            pass
+        return existing
 
-        if len(data) != piece.piece_length:
-            return False
+    def _is_resumable(self, piece: Piece, st: os.stat_result, resume_bitfield, saved_ns) -> bool:
+        """
+        A piece from the resume file can be trusted without hashing if its
+        file wasn't modified since the resume file was saved
+        """
+        return bool(resume_bitfield[piece.piece_index]) and st.st_mtime_ns <= saved_ns
 
-        if hashlib.sha1(data).digest() != piece.piece_hash:
+    def _check_piece_file(self, piece: Piece) -> bool:
+        """
+        Verify {index}.part against the piece hash.
+        The file is mapped rather than read, so it is hashed straight from the
+        page cache without copying it. Runs on worker threads: hashlib releases the GIL
+        """
+        try:
+            fd = os.open(f"file_pieces/{piece.piece_index}.part", os.O_RDONLY)
+        except FileNotFoundError:
             return False
+        try:
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as data:
+                if len(data) != piece.piece_length:
+                    return False
+                return sha1_digest(data) == piece.piece_hash
+        except ValueError:
+            return False # Empty file, can't be mapped
+        finally:
+            os.close(fd)
 
-        return True
+    def _load_completed_pieces(self):
+        """
+        Check the existing {index}.part files once at startup, instead of
+        probing the disk every time a piece is selected
+        """
+        resume = self._load_resume()
+        to_check = []
+        for index, st in self._scan_piece_files().items():
+            piece = self.pieces[index]
+            if st.st_size != piece.piece_length:
+                continue
+            if resume is not None and self._is_resumable(piece, st, *resume):
+                self._mark_completed(index)
+            else:
+                to_check.append(piece)
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            results = executor.map(self._check_piece_file, to_check)
+            for piece, valid in zip(to_check, results):
+                if valid:
+                    self._mark_completed(piece.piece_index)
+
+        if self.completed_pieces:
+            log.info("Found %d already downloaded pieces", len(self.completed_pieces))
 
-    def choose_next_piece(self, peer_bifield = None):
+    def _mark_completed(self, piece_index):
+        self.completed_pieces.add(piece_index)
+        self.available.discard(piece_index)
+        self.bitfield.set(piece_index)
+
+    def get_progress(self) -> float:
+        """
+        Percentage of pieces downloaded and verified
+        """
+        if not self.number_of_pieces:
+            return 100.0
+        return self.bitfield.count_ones() / self.number_of_pieces * 100
+
+    def is_complete(self) -> bool:
+        return self.bitfield.count_ones() == self.number_of_pieces
+
+    def is_piece_downloaded(self, piece: Piece) -> bool:
+        """
+        Checks if the piece was already downloaded and verified
+        """
+        return piece.piece_index in self.completed_pieces
+
+    def piece_bit(self, piece_index) -> int:
+        """
+        Bit of a piece in the piece bitmaps
+        """
+        return 1 << (self._mask_bits - 1 - piece_index)
+
+    def bitfield_mask(self, data) -> int:
+        """
+        Convert a peer's bitfield bytes to a piece bitmap, ignoring spare bits
+        """
+        mask = int.from_bytes(data, 'big')
+        shift = self._mask_bits - 8 * len(data)
+        mask = mask << shift if shift >= 0 else mask >> -shift
+        return mask & self._all_mask
+
+    def choose_next_piece(self, peer_have = None, wait = False):
         """
         Selects next piece to download.
 
         To be ran by the PeerManager when ordering a peer to download a piece
+
+        :param peer_have: Bitmap of the pieces the peer has (see bitfield_mask), None if unknown
+        :param wait: If no piece is free but other peers are downloading pieces
+                     this peer has, wait until they finish or fail instead of returning None
         """
-        for piece in self.pieces:
-            if piece.is_complete():
-                continue
-            if self.is_piece_downloaded(piece):
-                continue
-            if piece.piece_index in self.busy_pieces:
-                continue
-            if peer_bifield is not None:
-                if not peer_bifield[piece.piece_index]:
-                    continue
-            
-            self.busy_pieces.add(piece.piece_index)
-            return piece.piece_index
+        with self._changed:
+            while True:
+                candidates = self._free_mask
+                if peer_have is not None:
+                    candidates &= peer_have
+                if candidates:
+                    break
+                if not wait:
+                    return None
+                # Pieces other peers are still downloading, they become free again if they fail
+                in_progress = self.available & self.busy_pieces
+                if peer_have is not None:
+                    in_progress = [i for i in in_progress if peer_have & self.piece_bit(i)]
+                if not in_progress:
+                    return None
+                # The timeout makes sure a missed notification can't stall the peer forever
+                self._changed.wait(timeout=PIECE_WAIT_TIMEOUT)
+
+            piece_index = self._pick(candidates)
+            self.busy_pieces.add(piece_index)
+            self._free_mask &= ~self.piece_bit(piece_index)
+            return piece_index
+
+    def _pick(self, candidates: int) -> int:
+        """
+        Random piece out of a bitmap of candidates.
+        Pieces that failed before are only kept with their backoff weight as
+        probability, so they are less likely to be chosen
+        """
+        for _ in range(MAX_PICK_TRIES):
+            # The first candidate at or above a random bit, wrapping around
+            start = random.randrange(self._mask_bits)
+            above = candidates >> start
+            if above:
+                bit = start + (above & -above).bit_length() - 1
+            else:
+                bit = (candidates & -candidates).bit_length() - 1
+            piece_index = self._mask_bits - 1 - bit
+            if random.random() < _BACKOFF[self.failed_attempts[piece_index]]:
+                break
+        return piece_index
 
-    def release_piece(self, busy_piece_index):
-        self.busy_pieces.discard(busy_piece_index)
\ No newline at end of file
+    def release_piece(self, busy_piece_index, failed=False):
+        # Completed pieces were already removed from self.available
+        with self._changed:
+            if failed:
+                self.failed_attempts[busy_piece_index] = min(255, self.failed_attempts[busy_piece_index] + 1)
+            self.busy_pieces.discard(busy_piece_index)
+            if busy_piece_index in self.available:
+                self._free_mask |= self.piece_bit(busy_piece_index)
+            self._changed.notify_all()
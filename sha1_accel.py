@@ -0,0 +1,10 @@
+import hashlib
+
+# hashlib's sha1 is backed by OpenSSL, which dispatches to the SHA-NI / ARMv8
+# SHA1 instructions when the CPU has them. Every piece hash goes through this
+# module, so a different backend only needs to be plugged in here.
+sha1 = hashlib.sha1
+
+def sha1_digest(buf) -> bytes:
+    """Return the SHA1 digest of a piece buffer"""
+    return sha1(buf).digest()
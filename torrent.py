@@ -1,5 +1,12 @@
-import bencodepy
+import hashlib
 from datetime import datetime
+from functools import cached_property
+
+try:
+    # C implementation, much faster on large .torrent files
+    from better_bencode import dumps as bencode, loads as bdecode
+except ImportError:
+    from bencodepy import encode as bencode, decode as bdecode
 
 
 class Torrent:
@@ -28,7 +35,7 @@ class Torrent:
         # Open the .torrent file in binary mode
         with open(path, 'rb') as file:
             data = file.read()  # Read the file's content
-            data = bencodepy.decode(data)  # Decode the bencoded data
+            data = bdecode(data)  # Decode the bencoded data
 
             # Extract the 'announce' field (tracker URL)
             self.announce = data[b'announce'].decode('utf-8')
@@ -69,6 +76,13 @@ class Torrent:
                 self.file_length = data[b'info'][b'length']
                 self.files = [{'length': self.file_length, 'path': [self.name]}]
             
+    @cached_property
+    def info_hash(self) -> bytes:
+        """
+        SHA1 of the bencoded info dictionary, computed once per torrent
+        """
+        return hashlib.sha1(bencode(self.info_dict)).digest()
+
     def display_info(self):
         print(f"Name: {self.name}")
         print(f"Files: {self.files}")
@@ -1,10 +1,35 @@
-import hashlib
 import requests
-import bencodepy
 import random
-import socket
+import urllib.parse
+import struct
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from torrent import Torrent
 
+try:
+    # C implementation of bencode
+    from better_bencode import loads as bdecode
+except ImportError:
+    from bencodepy import decode as bdecode
+
+# Compact peer entry: 4 bytes IPv4 address, 2 bytes port
+_COMPACT_PEER = struct.Struct('>BBBBH')
+# Decimal string of every IP address octet, to build addresses without formatting
+_OCTETS = [str(i) for i in range(256)]
+
+def _create_session() -> requests.Session:
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=32)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+# HTTP session shared by every TrackerHandler, so announces reuse
+# keep-alive connections instead of a new TCP/TLS handshake each time
+_session = _create_session()
+
+# Our peer ID, generated once per process so it stays the same across announces
+_peer_id = None
+
 
 class TrackerHandler:
     """
@@ -16,19 +41,23 @@ class TrackerHandler:
         self.peer_id = self.generate_peer_id().encode()
         self.port = random.randint(6881, 6889)  # Typical BitTorrent client ports
 
-        self.info_hash = hashlib.sha1(bencodepy.encode(self.torrent.info_dict)).digest()
+        self.info_hash = self.torrent.info_hash
+        self.session = _session
         self.peers_list = []
     
     def generate_peer_id(self):
-        # Generate a 20-byte peer ID, e.g., -PYTHONCLIENT-00001
-        return "-PYTORRENT-" + "".join(str(random.randint(0, 9)) for _ in range(9))
+        # Generate a 20-byte peer ID, e.g., -PYTORRENT-123456789
+        global _peer_id
+        if _peer_id is None:
+            _peer_id = "-PYTORRENT-" + "".join(str(random.randint(0, 9)) for _ in range(9))
+        return _peer_id
 
 
     # Method to build the request 
-    def build_tracker_url(self, event:str = None):
+    def build_tracker_url(self, event:str = None, announce:str = None):
         # Create the query string to send to the tracker
         query_params = {
-            'info_hash': requests.utils.quote(self.info_hash),
+            'info_hash': self.info_hash,
             'peer_id': self.peer_id,
             'port': self.port,
             'uploaded': 0,
@@ -39,28 +68,60 @@ class TrackerHandler:
         if event:
             query_params['event'] = event
 
-        # Build the full tracker URL for GET request
-        query_string = "&".join([f"{k}={v}" for k, v in query_params.items()])
-        tracker_url = self.torrent.announce + "?" + query_string 
+        # Build the full tracker URL for GET request, percent-encoding every value
+        query_string = urllib.parse.urlencode(query_params, quote_via=urllib.parse.quote)
+        announce = announce or self.torrent.announce
+        separator = "&" if "?" in announce else "?"
+        tracker_url = announce + separator + query_string
         return tracker_url
     
+    def get_tiers(self) -> list:
+        """
+        Trackers to announce to, grouped in tiers by order of preference
+        """
+        tiers = [tier for tier in self.torrent.announce_list if tier]
+        return tiers or [[self.torrent.announce]]
+
     def send_request(self, event:str = None):
         """
-        Send a request to the tracker, parse the response
+        Send a request to the trackers, parse the first successful response.
+        All trackers of a tier are asked at once, so a dead tracker doesn't
+        hold up the others
+        """
+        for tier in self.get_tiers():
+            executor = ThreadPoolExecutor(max_workers=len(tier))
+            try:
+                futures = [executor.submit(self._announce, url, event) for url in tier]
+                for future in as_completed(futures):
+                    tracker_response = future.result()
+                    if tracker_response is not None:
+                        self.response = tracker_response
+                        self.parse_tracker_response(tracker_response)
+                        return
+            finally:
+                # Return on the first success, without waiting for the slower trackers
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    def _announce(self, announce: str, event:str = None):
         """
-        url = self.build_tracker_url(event)
-        
+        Announce to a single tracker
+
+        :return: The decoded tracker response, None if the request failed
+        """
+        if not announce.startswith(("http://", "https://")):
+            return None # UDP trackers aren't supported
+
+        url = self.build_tracker_url(event, announce)
         try:
-            response = requests.get(url, timeout=5)
+            response = self.session.get(url, timeout=5)
             if response.status_code == 200:
-                tracker_response = bencodepy.decode(response.content)
-                self.response = tracker_response
-                self.parse_tracker_response(tracker_response)
-
-            else:
-                print(f"Tracker request failed: HTTP {response.status_code}")
+                return bdecode(response.content)
+            print(f"Tracker request to {announce} failed: HTTP {response.status_code}")
         except requests.RequestException as e:
-            print(f"Tracker request failed: {e}")
+            print(f"Tracker request to {announce} failed: {e}")
+        except Exception as e:
+            print(f"Invalid response from tracker {announce}: {e}")
+        return None
 
     def parse_tracker_response(self, response: dict):
         # print(f"Tracker response: {response}")
@@ -69,9 +130,10 @@ class TrackerHandler:
             self.decode_peers(response[b'peers'])
                 
     def decode_peers(self, peers: bytes):
-        peers_list = []
-        for i in range(0, len(peers), 6):
-            ip = socket.inet_ntoa(peers[i:i+4]) # Decode IP from bytes
-            port = int.from_bytes(peers[i + 4:i + 6], 'big') # Decode port from bytes
-            peers_list.append((ip, port))
-        self.peers_list = peers_list
+        # Unpack all the 6 byte entries in one C-level pass, ignoring a truncated trailing entry
+        usable = len(peers) - len(peers) % _COMPACT_PEER.size
+        octets = _OCTETS
+        self.peers_list = [
+            ('.'.join((octets[a], octets[b], octets[c], octets[d])), port)
+            for a, b, c, d, port in _COMPACT_PEER.iter_unpack(memoryview(peers)[:usable])
+        ]